@@ -1,10 +1,27 @@
 import asyncio
-import base64
-import runpod
+import math
 import os
+import re
+import struct
 import sys
-from pathlib import Path
+import threading
 import traceback
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import runpod
+from numpy.typing import NDArray
+
+# pybase64 uses a SIMD encoder; fall back to the stdlib when it is not installed
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # --- FIX: Ensure project root is in python path ---
 # This ensures 'voicevox_engine' package is found regardless of how the script is called
@@ -36,116 +53,375 @@ except ImportError as e:
     traceback.print_exc()
     raise e
 
+# Presets are optional and static, so they are loaded once and only if the file is deployed
+_PRESET_PATH = Path("/app/presets.yaml")
+_PRESET_MANAGER = PresetManager(preset_path=_PRESET_PATH) if _PRESET_PATH.exists() else None
+
 # Global engine instance
 tts_engine = None
+# Guards the one-time engine initialization against concurrent callers
+_init_lock = threading.Lock()
+# Number of jobs RunPod may run on this worker at once (see `_concurrency_modifier`)
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1))
+
+# Reusable scratch buffer for the float -> int16 conversion, sized for MAX_SECONDS of audio.
+# Longer outputs fall back to a fresh allocation.
+MAX_SAMPLES = 24000 * int(os.environ.get("MAX_SECONDS", 60))
+_scratch_f32 = np.empty(MAX_SAMPLES, dtype=np.float32)
+_scratch_lock = threading.Lock()
+# Per-thread output buffer for WAV assembly (see `_get_buf`), capped at MAX_SECONDS of audio
+_tls = threading.local()
+
+# Base64 audio of recent requests, keyed by every input that affects the output.
+# The cache never holds more than AUDIO_CACHE_MAX_BYTES of base64 text (64 MiB by default);
+# larger results are not cached. Set AUDIO_CACHE_MAX_BYTES=0 to disable.
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+_audio_cache: OrderedDict[tuple[Any, ...], str] = OrderedDict()
+_audio_cache_bytes = 0
+_audio_cache_lock = threading.Lock()
+
+# Longer texts are rejected before they reach the engine
+MAX_TEXT_LEN = int(os.environ.get("MAX_TEXT_LEN", 2000))
+
+# Stream sentence by sentence instead of returning one WAV per job
+STREAM_OUTPUT = os.environ.get("STREAM_OUTPUT") == "1"
+# Runs a sentence's synthesis while the streaming handler runs OpenJTalk on the next one
+_stream_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="synthesis")
+# Split point after each Japanese sentence-ending mark
+_SENTENCE_END = re.compile(r"(?<=[。！？])")
+
+
+# cgroup v2 CPU quota of this container
+_CGROUP_CPU_MAX = Path("/sys/fs/cgroup/cpu.max")
+
+
+def _effective_cpus() -> int:
+    """Returns the number of CPU threads to give the core, honoring the container's CPU quota."""
+    if os.environ.get("VV_CPU_NUM_THREADS"):
+        return int(os.environ["VV_CPU_NUM_THREADS"])
+
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
 
+    # cgroup v2 reports "<quota> <period>" or "max <period>"
+    try:
+        quota, period = _CGROUP_CPU_MAX.read_text().split()
+        if quota != "max":
+            # A fractional quota (e.g. 1.9 CPUs) still gets the partially available CPU
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+
+    # Leave one CPU for the handler's own thread
+    return max(1, cpus - 1)
 
-async def initialize_engine():
+
+def _initialize_engine_sync():
     """Initializes the VOICEVOX engine with GPU support."""
     global tts_engine
     if tts_engine is not None:
         return tts_engine
 
-    print("--- Initializing VOICEVOX Engine (GPU) ---")
+    with _init_lock:
+        # Another caller may have finished initialization while we waited
+        if tts_engine is not None:
+            return tts_engine
+
+        print("--- Initializing VOICEVOX Engine (GPU) ---")
+
+        # 1. Define Core Paths
+        root_dir = Path("/app")
+        core_dir = root_dir / "voicevox_core"
+
+        if not core_dir.exists():
+            # Fallback for local testing
+            core_dir = Path("voicevox_core")
+
+        print(f"Core directory: {core_dir}")
+
+        # 2. Initialize CoreWrapper
+        # FIX: Removing invalid arguments 'voicelib_dir'.
+        # CoreWrapper only takes use_gpu, core_dir, cpu_num_threads, load_all_models
+        # NOTE: The ONNX Runtime sessions are created inside the voicevox_core shared library,
+        # so execution provider options (e.g. CUDA Graph capture, cudnn_conv_algo_search,
+        # the CPU fallback provider) can't be set from here. ONNX Runtime has no environment
+        # variable for the cuDNN algorithm search either. The same goes for precision: the
+        # models ship inside the core, so there is no ONNX file to convert to FP16 here.
+        # Padding inputs to fixed-size buckets isn't an option either: the decoder output
+        # length follows the phoneme frames, so padding would end up in the audio.
+        core = CoreWrapper(
+            use_gpu=True,
+            core_dir=core_dir,
+            cpu_num_threads=_effective_cpus(),
+            load_all_models=True
+        )
 
-    # 1. Define Core Paths
-    root_dir = Path("/app")
-    core_dir = root_dir / "voicevox_core"
+        # Note: core.initialize() is called inside CoreWrapper.__init__ in this version,
+        # so we don't need to call it manually unless we suppressed it.
 
-    if not core_dir.exists():
-        # Fallback for local testing
-        core_dir = Path("voicevox_core")
+        # 3. Initialize Managers
+        user_dict_manager = None
+        if UserDictManager:
+            try:
+                user_dict_manager = UserDictManager()
+            except Exception as e:
+                print(f"Warning: Failed to init UserDictManager: {e}")
 
-    print(f"Core directory: {core_dir}")
+        # Preset Manager
+        preset_manager = _PRESET_MANAGER
 
-    # 2. Initialize CoreWrapper
-    # FIX: Removing invalid arguments 'voicelib_dir'.
-    # CoreWrapper only takes use_gpu, core_dir, cpu_num_threads, load_all_models
-    core = CoreWrapper(
-        use_gpu=True,
-        core_dir=core_dir,
-        cpu_num_threads=4,
-        load_all_models=True
-    )
+        # 4. Initialize TTSEngine
+        # TTSEngine in your version takes only `core` in __init__
+        tts_engine = TTSEngine(
+            core=core
+        )
 
-    # Note: core.initialize() is called inside CoreWrapper.__init__ in this version,
-    # so we don't need to call it manually unless we suppressed it.
+        # If the engine needs managers injected separately (some versions do)
+        # tts_engine.user_dict_manager = user_dict_manager
+        # tts_engine.preset_manager = preset_manager
+
+        # 5. Optional warm-up
+        # A throwaway synthesis lets cuDNN/ORT finish their lazy setup before the first real job
+        if os.environ.get("PREWARM") == "1":
+            try:
+                accent_phrases = tts_engine.create_accent_phrases(
+                    text="あ", style_id=1, enable_katakana_english=False
+                )
+                audio_query = AudioQuery(
+                    accent_phrases=accent_phrases,
+                    speedScale=1.0,
+                    pitchScale=0.0,
+                    intonationScale=1.0,
+                    volumeScale=1.0,
+                    prePhonemeLength=0.0,
+                    postPhonemeLength=0.0,
+                    outputSamplingRate=24000,
+                    outputStereo=False,
+                )
+                tts_engine.synthesize_wave(
+                    query=audio_query, style_id=1, enable_interrogative_upspeak=False
+                )
+            except Exception as e:
+                print(f"Warning: Engine warm-up failed: {e}")
+
+        print("--- Engine Initialization Complete ---")
+        return tts_engine
 
-    # 3. Initialize Managers
-    user_dict_manager = None
-    if UserDictManager:
-        try:
-            user_dict_manager = UserDictManager()
-        except Exception as e:
-            print(f"Warning: Failed to init UserDictManager: {e}")
-
-    # Preset Manager
-    preset_path = root_dir / "presets.yaml"
-    if preset_path.exists():
-        preset_manager = PresetManager(preset_path=preset_path)
+
+def _get_buf(size: int) -> bytearray:
+    """Returns this thread's reusable WAV buffer, growing it to at least `size` bytes."""
+    buf = getattr(_tls, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(size)
+        _tls.buf = buf
+    return buf
+
+
+def _encode_wav(wave_data: NDArray[np.floating[Any]]) -> memoryview:
+    """
+    Converts a float wave in [-1, 1] to a mono 24kHz PCM_16 WAV file.
+    The result may be a view of a per-thread buffer, valid until the next call on the same thread.
+    """
+    n = len(wave_data)
+    size = 44 + 2 * n
+    # Header and samples are written into one buffer so they are only copied once.
+    if n <= MAX_SAMPLES:
+        wav_bytes = _get_buf(size)
     else:
-        # Pass a non-existent path to init default empty presets if needed
-        preset_manager = PresetManager(preset_path=Path("presets.yaml"))
+        wav_bytes = bytearray(size)
+    struct.pack_into(
+        '<4sI4s4sIHHIIHH4sI', wav_bytes, 0,
+        b'RIFF', 36 + 2 * n, b'WAVE',
+        b'fmt ', 16, 1, 1, 24000, 24000 * 2, 2, 16,
+        b'data', 2 * n
+    )
+    # The int16 samples are written straight into the WAV body through this view
+    pcm = np.frombuffer(wav_bytes, dtype=np.int16, count=n, offset=44)
+    # `wave_data` is read exactly once by the first ufunc, which handles non-contiguous
+    # input itself, so no np.ascontiguousarray copy is needed beforehand.
+    # Quantization matches libsndfile's PCM_16 writer: floor(x * 32768), clipped to int16.
+    if n <= MAX_SAMPLES:
+        with _scratch_lock:
+            scaled = _scratch_f32[:n]
+            np.multiply(wave_data, 32768.0, out=scaled)
+            np.floor(scaled, out=scaled)
+            np.clip(scaled, -32768.0, 32767.0, out=scaled)
+            pcm[:] = scaled
+    else:
+        pcm[:] = np.clip(np.floor(wave_data * 32768.0), -32768.0, 32767.0)
+    return memoryview(wav_bytes)[:size]
+
+
+# Returned for whitespace-only text instead of running the engine
+_EMPTY_WAV_BASE64 = base64.b64encode(_encode_wav(np.zeros(0, dtype=np.float32))).decode("ascii")
+
+
+def _get_cached_audio(key: tuple[Any, ...]) -> str | None:
+    """Returns the cached base64 audio for `key`, or None."""
+    with _audio_cache_lock:
+        base64_audio = _audio_cache.get(key)
+        if base64_audio is not None:
+            _audio_cache.move_to_end(key)
+        return base64_audio
+
+
+def _cache_audio(key: tuple[Any, ...], base64_audio: str) -> None:
+    """Stores base64 audio, evicting the least recently used entries to stay under the byte cap."""
+    global _audio_cache_bytes
+    # Base64 is ASCII, so its length is its size in bytes
+    size = len(base64_audio)
+    if size > AUDIO_CACHE_MAX_BYTES:
+        return
+    with _audio_cache_lock:
+        previous = _audio_cache.pop(key, None)
+        if previous is not None:
+            _audio_cache_bytes -= len(previous)
+        _audio_cache[key] = base64_audio
+        _audio_cache_bytes += size
+        while _audio_cache_bytes > AUDIO_CACHE_MAX_BYTES:
+            _, evicted = _audio_cache.popitem(last=False)
+            _audio_cache_bytes -= len(evicted)
+
+
+async def _threaded_handler(job):
+    """Runs the blocking handler on a thread so RunPod can overlap concurrent jobs."""
+    return await asyncio.to_thread(handler, job)
+
+
+async def _threaded_stream_handler(job):
+    """Pulls each streamed chunk on a thread so RunPod can overlap concurrent streaming jobs."""
+    chunks = stream_handler(job)
+    done = object()
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def _concurrency_modifier(current_concurrency):
+    """Tells RunPod how many jobs this worker accepts concurrently."""
+    return MAX_CONCURRENCY
+
+
+@lru_cache(maxsize=256)
+def _cached_accent(text, style_id, enable_katakana_english):
+    """Runs the text front-end once per (text, style, katakana-english) combination."""
+    # A tuple keeps the cached value from being mutated by callers;
+    # synthesize_wave deep-copies the query, so sharing the phrases is safe.
+    return tuple(
+        tts_engine.create_accent_phrases(
+            text=text,
+            style_id=style_id,
+            enable_katakana_english=enable_katakana_english
+        )
+    )
+
 
-    # 4. Initialize TTSEngine
-    # TTSEngine in your version takes only `core` in __init__
-    tts_engine = TTSEngine(
-        core=core
+def _read_options(job_input):
+    """Reads the synthesis options from a job input, falling back to the engine defaults."""
+    enable_katakana_english = bool(job_input.get("enable_katakana_english", True))
+    enable_interrogative_upspeak = bool(job_input.get("enable_interrogative_upspeak", True))
+    # Default values similar to standard engine defaults
+    query_params = {
+        "speedScale": float(job_input.get("speed_scale", 1.0)),
+        "pitchScale": float(job_input.get("pitch_scale", 0.0)),
+        "intonationScale": float(job_input.get("intonation_scale", 1.0)),
+        "volumeScale": float(job_input.get("volume_scale", 1.0)),
+        "prePhonemeLength": float(job_input.get("pre_phoneme_length", 0.1)),
+        "postPhonemeLength": float(job_input.get("post_phoneme_length", 0.1)),
+    }
+    return enable_katakana_english, enable_interrogative_upspeak, query_params
+
+
+def _build_query(text, speaker_id, enable_katakana_english, query_params):
+    """Runs the text front-end for `text` and builds its AudioQuery."""
+    # 1. Audio Query
+    # Mimicking run.py logic
+
+    # A. Create Accent Phrases
+    # TTSEngine.create_accent_phrases signature: (text, style_id, enable_katakana_english)
+    # Results are cached, so repeated phrases skip the OpenJTalk front-end
+    accent_phrases = _cached_accent(text, speaker_id, enable_katakana_english)
+
+    # B. Construct AudioQuery
+    audio_query = AudioQuery(
+        accent_phrases=list(accent_phrases),
+        **query_params,
+        outputSamplingRate=24000,
+        outputStereo=False,
     )
 
-    # If the engine needs managers injected separately (some versions do)
-    # tts_engine.user_dict_manager = user_dict_manager
-    # tts_engine.preset_manager = preset_manager
+    return audio_query
+
+
+def _split_sentences(text: str) -> list[str]:
+    """Splits text after each sentence-ending mark, dropping blank pieces."""
+    return [sentence for sentence in _SENTENCE_END.split(text) if sentence.strip()]
 
-    print("--- Engine Initialization Complete ---")
-    return tts_engine
+
+def _validate_text(text: Any) -> dict[str, Any] | None:
+    """Checks the requested text, returning the response for texts that need no synthesis."""
+    if not text:
+        return {"error": "Missing 'text' in input"}
+    if not isinstance(text, str):
+        return {"error": "'text' must be a string", "status": "failed"}
+    if len(text) > MAX_TEXT_LEN:
+        return {"error": f"'text' exceeds {MAX_TEXT_LEN} characters", "status": "failed"}
+    if not text.strip():
+        return {
+            "audio_base64": _EMPTY_WAV_BASE64,
+            "sampling_rate": 24000,
+            "status": "success"
+        }
+    return None
 
 
-async def handler(job):
+def handler(job: dict[str, Any]) -> dict[str, Any]:
     """
     RunPod Handler
     Input: {"input": {"text": "...", "speaker_id": 1, ...}}
     """
     global tts_engine
 
-    # Warm up engine
+    # The engine is normally preloaded at startup; this only runs with LAZY_INIT set
     if tts_engine is None:
-        await initialize_engine()
+        _initialize_engine_sync()
 
     job_input = job.get("input", {})
 
     # Validate Input
     text = job_input.get("text")
-    if not text:
-        return {"error": "Missing 'text' in input"}
+    response = _validate_text(text)
+    if response is not None:
+        return response
 
     speaker_id = int(job_input.get("speaker_id", 1))
 
     try:
-        # 1. Audio Query
-        # Mimicking run.py logic
-
-        # A. Create Accent Phrases
-        # TTSEngine.create_accent_phrases signature: (text, style_id, enable_katakana_english)
-        accent_phrases = tts_engine.create_accent_phrases(
-            text=text,
-            style_id=speaker_id,
-            enable_katakana_english=job_input.get("enable_katakana_english", True)
+        enable_katakana_english, enable_interrogative_upspeak, query_params = (
+            _read_options(job_input)
         )
 
-        # B. Construct AudioQuery
-        # Default values similar to standard engine defaults
-        audio_query = AudioQuery(
-            accent_phrases=accent_phrases,
-            speedScale=float(job_input.get("speed_scale", 1.0)),
-            pitchScale=float(job_input.get("pitch_scale", 0.0)),
-            intonationScale=float(job_input.get("intonation_scale", 1.0)),
-            volumeScale=float(job_input.get("volume_scale", 1.0)),
-            prePhonemeLength=float(job_input.get("pre_phoneme_length", 0.1)),
-            postPhonemeLength=float(job_input.get("post_phoneme_length", 0.1)),
-            outputSamplingRate=24000,
-            outputStereo=False,
+        # Identical requests reuse the already encoded audio
+        cache_key = (
+            text,
+            speaker_id,
+            enable_katakana_english,
+            enable_interrogative_upspeak,
+            *query_params.values(),
         )
+        base64_audio = _get_cached_audio(cache_key)
+        if base64_audio is not None:
+            return {
+                "audio_base64": base64_audio,
+                "sampling_rate": 24000,
+                "status": "success"
+            }
+
+        audio_query = _build_query(text, speaker_id, enable_katakana_english, query_params)
 
         # 2. Synthesis
         print(f"Synthesizing: '{text}' (Speaker: {speaker_id})")
@@ -153,20 +429,17 @@ async def handler(job):
         wave_data = tts_engine.synthesize_wave(
             query=audio_query,
             style_id=speaker_id,
-            enable_interrogative_upspeak=job_input.get("enable_interrogative_upspeak", True)
+            enable_interrogative_upspeak=enable_interrogative_upspeak
         )
 
         # 3. Return Result
-        # Convert float32 numpy array to WAV bytes
-        import io
-        import soundfile as sf
-
-        buffer = io.BytesIO()
+        # Convert float32 numpy array to 16-bit PCM and prepend a plain RIFF header.
+        # This skips libsndfile entirely; the output is a standard mono PCM_16 WAV.
         # Voicevox output is typically 24k sample rate
-        sf.write(buffer, wave_data, 24000, format='WAV', subtype='PCM_16')
-        wav_bytes = buffer.getvalue()
+        wav_bytes = _encode_wav(wave_data)
 
-        base64_audio = base64.b64encode(wav_bytes).decode("utf-8")
+        base64_audio = base64.b64encode(wav_bytes).decode("ascii")
+        _cache_audio(cache_key, base64_audio)
 
         return {
             "audio_base64": base64_audio,
@@ -180,9 +453,111 @@ async def handler(job):
         return {"error": str(e), "status": "failed"}
 
 
+def _stream_chunk(index: int, wave_data: NDArray[np.floating[Any]]) -> dict[str, Any]:
+    """Encodes one synthesized sentence as a streamed output chunk."""
+    return {
+        "audio_base64": base64.b64encode(_encode_wav(wave_data)).decode("ascii"),
+        "sampling_rate": 24000,
+        "sentence_index": index,
+        "status": "success"
+    }
+
+
+def stream_handler(job: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    """
+    RunPod streaming handler (enabled with STREAM_OUTPUT=1)
+    Input: same as `handler`
+    Yields one WAV per sentence as soon as it is synthesized, so the first audio
+    arrives after the first sentence rather than after the whole text.
+    """
+    # The engine is normally preloaded at startup; this only runs with LAZY_INIT set
+    if tts_engine is None:
+        _initialize_engine_sync()
+
+    job_input = job.get("input", {})
+
+    # Validate Input
+    text = job_input.get("text")
+    response = _validate_text(text)
+    if response is not None:
+        if response.get("status") == "success":
+            # Blank text streams as a single empty sentence
+            response["sentence_index"] = 0
+        yield response
+        return
+
+    speaker_id = int(job_input.get("speaker_id", 1))
+
+    # Synthesis of the most recently submitted sentence that has not been handed out yet
+    pending = None
+    try:
+        enable_katakana_english, enable_interrogative_upspeak, query_params = (
+            _read_options(job_input)
+        )
+
+        # Sentence N+1 goes through the front-end before we wait on sentence N. Only its
+        # OpenJTalk analysis overlaps with sentence N's decode: the length/pitch models
+        # in update_length_and_pitch take CoreAdapter.mutex, which decode_forward holds
+        for index, sentence in enumerate(_split_sentences(text)):
+            try:
+                audio_query = _build_query(
+                    sentence, speaker_id, enable_katakana_english, query_params
+                )
+            except Exception:
+                # Hand out the sentence that is already being synthesized before the error
+                if pending is not None:
+                    finished, pending = pending, None
+                    yield _stream_chunk(index - 1, finished.result())
+                raise
+            print(f"Synthesizing: '{sentence}' (Speaker: {speaker_id})")
+            future = _stream_executor.submit(
+                tts_engine.synthesize_wave,
+                query=audio_query,
+                style_id=speaker_id,
+                enable_interrogative_upspeak=enable_interrogative_upspeak
+            )
+            finished, pending = pending, future
+            if finished is not None:
+                yield _stream_chunk(index - 1, finished.result())
+        if pending is not None:
+            finished, pending = pending, None
+            yield _stream_chunk(index, finished.result())
+
+    except Exception as e:
+        print(f"Error processing request: {e}")
+        traceback.print_exc()
+        yield {"error": str(e), "status": "failed"}
+
+    finally:
+        # Don't leave a synthesis nobody will read queued on the single executor thread,
+        # e.g. after an error or when the consumer stops early
+        if pending is not None:
+            pending.cancel()
+
+
 if __name__ == "__main__":
+    # Load the models before accepting jobs so the first request doesn't pay the cold start
+    if not os.environ.get("LAZY_INIT"):
+        _initialize_engine_sync()
+
     # Allow running locally for testing
     if len(sys.argv) > 1 and sys.argv[1] == "test":
-        asyncio.run(handler({"input": {"text": "テストです"}}))
+        if STREAM_OUTPUT:
+            list(stream_handler({"input": {"text": "テストです"}}))
+        else:
+            handler({"input": {"text": "テストです"}})
+    elif STREAM_OUTPUT:
+        # RunPod streams each yielded chunk and also aggregates them into the job output.
+        # Like `handler`, the sync generator only needs a thread when jobs run concurrently.
+        runpod.serverless.start({
+            "handler": stream_handler if MAX_CONCURRENCY == 1 else _threaded_stream_handler,
+            "return_aggregate_stream": True,
+            "concurrency_modifier": _concurrency_modifier
+        })
     else:
-        runpod.serverless.start({"handler": handler})
\ No newline at end of file
+        # A sync handler blocks RunPod's event loop, so it only needs a thread when
+        # several jobs are allowed to run at once
+        runpod.serverless.start({
+            "handler": handler if MAX_CONCURRENCY == 1 else _threaded_handler,
+            "concurrency_modifier": _concurrency_modifier
+        })
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""RunPod ハンドラーの単体テスト。"""
+
+import base64
+import io
+import os
+import sys
+import types
+from collections import OrderedDict
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+import soundfile
+from numpy.typing import NDArray
+
+# runpod はコンテナ内でのみ導入される。ハンドラーは `__main__` でしか使わないため空モジュールで代用する
+sys.modules.setdefault("runpod", types.ModuleType("runpod"))
+
+import handler  # noqa: E402
+
+
+def _encode_with_soundfile(wave: NDArray[np.float32]) -> bytes:
+    wave_bio = io.BytesIO()
+    soundfile.write(
+        file=wave_bio, data=wave, samplerate=24000, format="WAV", subtype="PCM_16"
+    )
+    return wave_bio.getvalue()
+
+
+def _generate_wave(num_samples: int) -> NDArray[np.float32]:
+    rng = np.random.default_rng(0)
+    # クリッピングと 0 付近の量子化も確認できるよう [-1.2, 1.2) の一様乱数に境界値を加える
+    wave = rng.uniform(-1.2, 1.2, num_samples).astype(np.float32)
+    edges = [0.0, 1.0, -1.0, 1 / 32768, -1 / 32768, 0.5 / 32767]
+    wave[: len(edges)] = edges[:num_samples]
+    return wave
+
+
+@pytest.mark.parametrize("num_samples", [0, 100, 24000])
+def test_encode_wav_matches_soundfile(num_samples: int) -> None:
+    wave = _generate_wave(num_samples)
+    assert bytes(handler._encode_wav(wave)) == _encode_with_soundfile(wave)
+
+
+def test_encode_wav_without_scratch_buffer_matches_soundfile(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # 再利用バッファに収まらない長さの音声を模擬する
+    monkeypatch.setattr(handler, "MAX_SAMPLES", 0)
+    wave = _generate_wave(24000)
+    assert bytes(handler._encode_wav(wave)) == _encode_with_soundfile(wave)
+
+
+def test_encode_wav_reuses_buffer_safely() -> None:
+    long_wave = _generate_wave(24000)
+    short_wave = _generate_wave(100)
+    handler._encode_wav(long_wave)
+    assert bytes(handler._encode_wav(short_wave)) == _encode_with_soundfile(short_wave)
+
+
+@pytest.fixture
+def empty_audio_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    """音声キャッシュを空の状態にする。"""
+    monkeypatch.setattr(handler, "_audio_cache", OrderedDict())
+    monkeypatch.setattr(handler, "_audio_cache_bytes", 0)
+
+
+@pytest.mark.usefixtures("empty_audio_cache")
+def test_audio_cache_evicts_least_recently_used(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(handler, "AUDIO_CACHE_MAX_BYTES", 8)
+    handler._cache_audio(("a",), "aaaa")
+    handler._cache_audio(("b",), "bbbb")
+    # 参照された "a" は最近使われた扱いになり、"b" が先に追い出される
+    assert handler._get_cached_audio(("a",)) == "aaaa"
+    handler._cache_audio(("c",), "cccc")
+    assert list(handler._audio_cache) == [("a",), ("c",)]
+    assert handler._get_cached_audio(("b",)) is None
+    assert handler._audio_cache_bytes == 8
+
+
+@pytest.mark.usefixtures("empty_audio_cache")
+def test_audio_cache_skips_entry_larger_than_cap(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(handler, "AUDIO_CACHE_MAX_BYTES", 8)
+    handler._cache_audio(("a",), "aaaa")
+    handler._cache_audio(("big",), "x" * 9)
+    assert handler._get_cached_audio(("big",)) is None
+    assert list(handler._audio_cache) == [("a",)]
+    assert handler._audio_cache_bytes == 4
+
+
+@pytest.mark.usefixtures("empty_audio_cache")
+def test_audio_cache_reinsert_keeps_byte_count(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(handler, "AUDIO_CACHE_MAX_BYTES", 8)
+    handler._cache_audio(("a",), "aaaa")
+    handler._cache_audio(("b",), "bb")
+    handler._cache_audio(("a",), "aaaaaa")
+    assert handler._audio_cache_bytes == 8
+    assert list(handler._audio_cache) == [("b",), ("a",)]
+    assert handler._get_cached_audio(("a",)) == "aaaaaa"
+
+
+@pytest.mark.usefixtures("empty_audio_cache")
+def test_audio_cache_disabled_by_zero_cap(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(handler, "AUDIO_CACHE_MAX_BYTES", 0)
+    handler._cache_audio(("a",), "aaaa")
+    assert handler._get_cached_audio(("a",)) is None
+    assert handler._audio_cache_bytes == 0
+
+
+@pytest.fixture
+def eight_cpus(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    """CPU 8 個の環境を模擬し、cgroup の `cpu.max` の置き場所を返す。"""
+    monkeypatch.delenv("VV_CPU_NUM_THREADS", raising=False)
+    monkeypatch.setattr(
+        os, "sched_getaffinity", lambda pid: set(range(8)), raising=False
+    )
+    cpu_max = tmp_path / "cpu.max"
+    monkeypatch.setattr(handler, "_CGROUP_CPU_MAX", cpu_max)
+    return cpu_max
+
+
+def test_effective_cpus_env_override(
+    monkeypatch: pytest.MonkeyPatch, eight_cpus: Path
+) -> None:
+    monkeypatch.setenv("VV_CPU_NUM_THREADS", "3")
+    eight_cpus.write_text("100000 100000\n")
+    assert handler._effective_cpus() == 3
+
+
+def test_effective_cpus_without_cgroup_file(eight_cpus: Path) -> None:
+    assert handler._effective_cpus() == 7
+
+
+def test_effective_cpus_unlimited_quota(eight_cpus: Path) -> None:
+    eight_cpus.write_text("max 100000\n")
+    assert handler._effective_cpus() == 7
+
+
+@pytest.mark.parametrize(
+    ("cpu_max", "expected"),
+    [
+        ("400000 100000\n", 3),
+        # 1.9 CPU は 2 CPU に切り上げてからハンドラー用の 1 CPU を差し引く
+        ("190000 100000\n", 1),
+        ("250000 100000\n", 2),
+        ("50000 100000\n", 1),
+    ],
+)
+def test_effective_cpus_limited_quota(
+    eight_cpus: Path, cpu_max: str, expected: int
+) -> None:
+    eight_cpus.write_text(cpu_max)
+    assert handler._effective_cpus() == expected
+
+
+class _FakeEngine:
+    """呼び出し順に 1, 2, 3, ... サンプルの無音を返す TTS エンジンの代用品。"""
+
+    def __init__(self, failing_text: str | None = None) -> None:
+        self.failing_text = failing_text
+        self.synthesized = 0
+
+    def create_accent_phrases(
+        self, text: str, style_id: int, enable_katakana_english: bool
+    ) -> list[Any]:
+        if text == self.failing_text:
+            raise RuntimeError("front-end failure")
+        return []
+
+    def synthesize_wave(
+        self, query: Any, style_id: int, enable_interrogative_upspeak: bool
+    ) -> NDArray[np.float32]:
+        self.synthesized += 1
+        return np.zeros(self.synthesized, dtype=np.float32)
+
+
+@pytest.fixture(autouse=True)
+def clear_accent_cache() -> Iterator[None]:
+    """テスト間でアクセント句キャッシュを共有しない。"""
+    handler._cached_accent.cache_clear()
+    yield
+    handler._cached_accent.cache_clear()
+
+
+def _decoded_length(base64_audio: str) -> int:
+    # 44 バイトのヘッダーに 16 bit モノラルのサンプルが続く
+    return (len(base64.b64decode(base64_audio)) - 44) // 2
+
+
+def test_stream_handler_yields_sentences_in_order(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    engine = _FakeEngine()
+    monkeypatch.setattr(handler, "tts_engine", engine)
+    chunks = list(handler.stream_handler({"input": {"text": "あ。い！う"}}))
+    assert [chunk["sentence_index"] for chunk in chunks] == [0, 1, 2]
+    assert [_decoded_length(chunk["audio_base64"]) for chunk in chunks] == [1, 2, 3]
+
+
+def test_stream_handler_delivers_pending_sentence_before_error(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    engine = _FakeEngine(failing_text="い。")
+    monkeypatch.setattr(handler, "tts_engine", engine)
+    chunks = list(handler.stream_handler({"input": {"text": "あ。い。う"}}))
+    # 合成中だった 1 文目を届けてから失敗を返し、3 文目は合成しない
+    assert chunks[0]["sentence_index"] == 0
+    assert _decoded_length(chunks[0]["audio_base64"]) == 1
+    assert chunks[1]["status"] == "failed"
+    assert len(chunks) == 2
+    assert engine.synthesized == 1
+
+
+class _UntouchedEngine:
+    """入力検証だけで応答が決まる場合に、エンジンが使われないことを確かめる代用品。"""
+
+    def __getattr__(self, name: str) -> Any:
+        raise AssertionError(f"engine.{name} must not be used")
+
+
+def _respond(stream: bool, text: Any) -> dict[str, Any]:
+    job = {"input": {"text": text}}
+    if stream:
+        (response,) = handler.stream_handler(job)
+        return response
+    return handler.handler(job)
+
+
+@pytest.fixture
+def untouched_engine(monkeypatch: pytest.MonkeyPatch) -> None:
+    """エンジンを触ると失敗する代用品に差し替える。"""
+    monkeypatch.setattr(handler, "tts_engine", _UntouchedEngine())
+
+
+@pytest.mark.usefixtures("untouched_engine")
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("text", [123, ["あ"]])
+def test_handler_rejects_non_string_text(stream: bool, text: Any) -> None:
+    assert _respond(stream, text)["status"] == "failed"
+
+
+@pytest.mark.usefixtures("untouched_engine")
+@pytest.mark.parametrize("stream", [False, True])
+def test_handler_rejects_too_long_text(
+    monkeypatch: pytest.MonkeyPatch, stream: bool
+) -> None:
+    monkeypatch.setattr(handler, "MAX_TEXT_LEN", 5)
+    assert _respond(stream, "あいうえおか")["status"] == "failed"
+
+
+@pytest.mark.usefixtures("untouched_engine")
+@pytest.mark.parametrize("stream", [False, True])
+def test_handler_returns_empty_wav_for_blank_text(stream: bool) -> None:
+    response = _respond(stream, " 　\n")
+    assert response["status"] == "success"
+    assert response["audio_base64"] == handler._EMPTY_WAV_BASE64